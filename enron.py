@@ -1,11 +1,15 @@
+import io
 import os
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # import our classifier, assumed to be in same directory
 from classifier import NBC
 
 
 def train(corpus='corpus'):
-    classifier = NBC(filename='enron.kct')
+    classifier = NBC(filename='enron.kct', bulk_train_mode=True)
     curdir = os.path.dirname(__file__)
 
     # paths to spam and ham documents
@@ -18,35 +22,84 @@ def train(corpus='corpus'):
     # train the classifier with the ham documents
     train_category(classifier, ham_dir, 'ham')
 
+    # write the accumulated counts to the database
+    classifier.flush()
+
     return classifier
 
 
-def train_category(classifier, path, label):
-    files = os.listdir(path)
-    print 'Preparing to train %s %s files' % (len(files), label)
-    for filename in files:
-        with open(os.path.join(path, filename)) as fh:
-            contents = fh.read()
+def list_files(path):
+    """
+    Return the full paths of the regular files in the directory `path`,
+    using a single scan of the directory.
+    """
+    with os.scandir(path) as it:
+        return [entry.path for entry in it if entry.is_file()]
+
+
+def read_file(filename):
+    """Read the raw contents of `filename` with a single unbuffered read."""
+    with io.open(filename, 'rb', buffering=0) as fh:
+        return fh.read()
+
 
-        # extract the words from the document
-        features = extract_features(contents)
+def read_features(filename):
+    """Read `filename` and extract the words from the document."""
+    return extract_features(read_file(filename))
 
-        # train the classifier to associate the features with the label
-        classifier.train(features, label)
 
-    print 'Trained %s files' % len(files)
+def train_category(classifier, path, label, max_workers=8):
+    files = list_files(path)
+    print('Preparing to train %s %s files' % (len(files), label))
+
+    # read and tokenize the files on a pool of threads, while this thread
+    # does all the training since Kyoto Cabinet only allows a single writer.
+    # the tokenizer holds the GIL, so it is really the file reads that
+    # overlap with training. at most `2 * max_workers` files are in flight
+    # at once, so the features of the whole corpus never pile up in memory.
+    remaining = iter(files)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque(
+            executor.submit(read_features, filename)
+            for _, filename in zip(range(2 * max_workers), remaining))
+        while pending:
+            features = pending.popleft().result()
+            filename = next(remaining, None)
+            if filename is not None:
+                pending.append(executor.submit(read_features, filename))
+
+            # train the classifier to associate the features with the label
+            classifier.train(features, label)
+
+    print('Trained %s files' % len(files))
+
+# Matches whitespace-delimited words of a bounded length. The compiled
+# patterns cover the default bounds used by `extract_features()`, 3 to 19
+# characters long, for bytes and text documents respectively.
+_WORD_PATTERN = r'(?<!\S)\S{%d,%d}(?!\S)'
+_WORD_RE = re.compile((_WORD_PATTERN % (3, 19)).encode('ascii'))
+_TEXT_WORD_RE = re.compile(_WORD_PATTERN % (3, 19))
+
 
 def extract_features(s, min_len=2, max_len=20):
     """
-    Extract all the words in the string `s` that have a length within
-    the specified bounds
+    Extract all the words in the bytes or string `s` that have a length
+    within the specified bounds. The words are the same type as `s`.
     """
-    words = []
-    for w in s.lower().split():
-        wlen = len(w)
-        if wlen > min_len and wlen < max_len:
-            words.append(w)
-    return words
+    is_bytes = isinstance(s, bytes)
+    if min_len == 2 and max_len == 20:
+        word_re = _WORD_RE if is_bytes else _TEXT_WORD_RE
+    else:
+        # words are never empty, even if `min_len` is negative
+        shortest = max(min_len + 1, 1)
+        longest = max_len - 1
+        if shortest > longest:
+            return []
+        pattern = _WORD_PATTERN % (shortest, longest)
+        if is_bytes:
+            pattern = pattern.encode('ascii')
+        word_re = re.compile(pattern)
+    return word_re.findall(s.lower())
 
 
 def test(classifier, corpus='corpus2'):
@@ -59,18 +112,15 @@ def test(classifier, corpus='corpus2'):
     correct = total = 0
 
     for path, label in ((spam_dir, 'spam'), (ham_dir, 'ham')):
-        filenames = os.listdir(path)
-        print 'Preparing to test %s %s files from %s.' % (
+        filenames = list_files(path)
+        print('Preparing to test %s %s files from %s.' % (
             len(filenames),
             label,
-            corpus)
-
-        for filename in os.listdir(path):
-            with open(os.path.join(path, filename)) as fh:
-                contents = fh.read()
+            corpus))
 
-            # extract the words from the document
-            features = extract_features(contents)
+        for filename in filenames:
+            # read the document and extract its words
+            features = read_features(filename)
 
             results = classifier.classify(features)
 
@@ -79,7 +129,10 @@ def test(classifier, corpus='corpus2'):
             total += 1
 
     pct = 100 * (float(correct) / total)
-    print '[%s]: processed %s documents, %02f%% accurate' % (corpus, total, pct)
+    print('[%s]: processed %s documents, %02f%% accurate' % (
+        corpus,
+        total,
+        pct))
 
 if __name__ == '__main__':
     classifier = train()
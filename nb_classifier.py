@@ -1,45 +1,280 @@
+import hashlib
+import heapq
+import math
 import operator
+from collections import Counter, OrderedDict, defaultdict
 import struct
+from contextlib import contextmanager
 import kyotocabinet as kc
 
+try:
+    import numpy as np
+    from numba import njit
+except ImportError:
+    np = njit = None
+
+
+def _to_bytes(value):
+    # Keys are built as bytes; features read from disk already are, while
+    # categories (and features passed by callers) may be text.
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+# Unpacker for Kyoto's 8-byte ints, bound once so the format string is not
+# re-parsed on every read.
+_unpack_int = struct.Struct('>Q').unpack
+
+# Packed feature records hold one 8-byte count per category; their `Struct`s
+# are compiled once per slot count by `_counts_struct()`.
+_counts_structs = {}
+
+
+def _counts_struct(n):
+    try:
+        return _counts_structs[n]
+    except KeyError:
+        _counts_structs[n] = struct.Struct('>%dQ' % n)
+        return _counts_structs[n]
+
+# Probabilities are floored at this value before taking the log.
+MIN_PROBABILITY = 1e-12
+
+# Number of feature records read and written per bulk call when flushing
+# counts accumulated in bulk training mode.
+FLUSH_CHUNK_SIZE = 10000
+
+# Maximum number of feature sets whose scores `NBC.classify()` remembers.
+# Entries are keyed by a digest, so each costs well under 1KB with a handful
+# of categories.
+CLASSIFY_CACHE_SIZE = 10000
+
+# Packs a feature's length and occurrence count when digesting feature sets.
+_pack_feature_count = struct.Struct('>QQ').pack
+
+
+if njit is not None:
+    @njit(cache=True, parallel=True)
+    def _score(fcc_arr, cat_count, totals_arr, occurrences_arr, weight=1.0):
+        # Compiled equivalent of summing the logs of `weighted_probability()`
+        # for every feature, given arrays of the per-category and total
+        # feature counts, and of how often each feature occurs.
+        probs = (((weight * 0.5) + totals_arr * (fcc_arr / cat_count)) /
+                 (weight + totals_arr))
+        return np.sum(
+            occurrences_arr * np.log(np.maximum(probs, MIN_PROBABILITY)))
+else:
+    _score = None
+
 
 class ClassifierDB(kc.DB):
     """
     Wrapper for `kyotocabinet.DB` that provides utilities for working with
     features and categories.
+
+    Each feature is stored under a single key whose value packs the
+    feature's count in every category, one big-endian 8-byte int per
+    category. Categories are assigned a slot in that array the first time
+    they are seen, and the slot assignments are persisted alongside the
+    counts.
     """
+    __slots__ = ('_categories', '_category_index', '_saved_categories')
+
+    _category_tmpl = b'category.%s'
+    _category_index_key = b'__catidx__'
+    _feature_tmpl = b'f:%s'
+    _total_count = b'total-count'
+
     def __init__(self, *args, **kwargs):
         super(ClassifierDB, self).__init__(*args, **kwargs)
 
-        self._category_tmpl = 'category.%s'
-        self._feature_to_category_tmpl = 'feature2category.%s.%s'
-        self._total_count = 'total-count'
+        # Category names in slot order, and the reverse mapping.
+        self._categories = []
+        self._category_index = {}
+        # How many of the categories are recorded in the persisted index.
+        self._saved_categories = 0
+
+    def open(self, *args, **kwargs):
+        """
+        Open the database and load the category slot assignments. Raises
+        `RuntimeError` for a database trained with the older layout, which
+        kept a key per feature and category and has no slot index.
+        """
+        result = super(ClassifierDB, self).open(*args, **kwargs)
+        if result:
+            if (self.get(self._category_index_key) is None and
+                    self.get(self._total_count) is not None):
+                self.close()
+                raise RuntimeError(
+                    'Database uses an older layout without a category '
+                    'index and must be retrained.')
+            self._load_category_index()
+        return result
+
+    def end_transaction(self, commit=True):
+        """
+        End the current transaction. When it is aborted, any categories
+        registered during it are rolled back along with their slots, so
+        the in-memory index is reloaded from the database.
+        """
+        result = super(ClassifierDB, self).end_transaction(commit)
+        if not commit:
+            self._load_category_index()
+        return result
+
+    def _check(self, result):
+        # Unless the database is opened in exceptional mode, Kyoto reports
+        # failures through return values (False, None or -1) rather than
+        # raising, so turn them into exceptions.
+        if result is None or result is False or result == -1:
+            raise self.error()
+        return result
+
+    @contextmanager
+    def transaction(self):
+        """
+        Context manager that wraps a block of writes in a transaction. The
+        transaction is committed if the block succeeds, and aborted if it
+        raises, including for writes whose failure is checked by
+        `_check()`.
+        """
+        self._check(self.begin_transaction())
+        try:
+            yield
+        except:
+            self.end_transaction(False)
+            raise
+        self._check(self.end_transaction())
+
+    def _load_category_index(self):
+        value = self.get(self._category_index_key)
+        self._categories = value.decode('utf-8').split('\n') if value else []
+        self._category_index = dict(
+            (category, slot) for slot, category in enumerate(self._categories))
+        self._saved_categories = len(self._categories)
+
+    def _category_slot(self, category):
+        # Return the slot for the category, registering it if it is new. The
+        # persisted index is rewritten until it matches the one in memory,
+        # so a failed write is retried rather than leaving the slot
+        # unrecorded.
+        if category not in self._category_index:
+            # The index is persisted as newline-separated names, which only
+            # round-trips non-empty names without newlines.
+            if not category or '\n' in category:
+                raise ValueError(
+                    'Category names must be non-empty and must not contain '
+                    'newlines: %r' % (category,))
+            self._category_index[category] = len(self._categories)
+            self._categories.append(category)
+        if self._saved_categories != len(self._categories):
+            if self.set(
+                    self._category_index_key,
+                    '\n'.join(self._categories).encode('utf-8')):
+                self._saved_categories = len(self._categories)
+        return self._category_index[category]
+
+    def _category_key(self, category):
+        return self._category_tmpl % _to_bytes(category)
+
+    def _feature_key(self, feature):
+        return self._feature_tmpl % _to_bytes(feature)
+
+    def _unpack_counts(self, value):
+        # Features stored before a category was registered have fewer slots
+        # than there are categories, so pad the missing ones with zeros.
+        counts = [0] * len(self._categories)
+        if value:
+            n = len(value) // 8
+            counts[:n] = _counts_struct(n).unpack(value)
+        return counts
+
+    def _pack_counts(self, counts):
+        return _counts_struct(len(counts)).pack(*counts)
 
     def get_int(self, key):
         # Kyoto serializes ints big-endian 8-bytes long, so we need to unpack
         # them using the `struct` module.
         value = self.get(key)
         if value:
-            return struct.unpack('>Q', value)[0]
+            return _unpack_int(value)[0]
         return 0
 
-    def incr_feature_category(self, feature, category):
+    def incr_feature_category(self, feature, category, count=1):
         """Increment the count for the feature in the given category."""
-        return self.increment(
-            self._feature_to_category_tmpl % (feature, category),
-            1)
+        slot = self._category_slot(category)
+        key = self._feature_key(feature)
+        counts = self._unpack_counts(self.get(key))
+        counts[slot] += count
+        self._check(self.set(key, self._pack_counts(counts)))
+        return counts[slot]
+
+    def incr_feature_categories(self, feature_counts, categories):
+        """
+        Add the counts in `feature_counts`, a dictionary mapping feature to
+        count, to each of the given categories. All the features are read
+        with one bulk get and written back with one bulk set.
+        """
+        slots = [self._category_slot(category) for category in categories]
+        keys = dict(
+            (feature, self._feature_key(feature))
+            for feature in feature_counts)
+        values = self._check(self.get_bulk(list(keys.values()), False))
+
+        records = {}
+        for feature, count in feature_counts.items():
+            key = keys[feature]
+            counts = self._unpack_counts(values.get(key))
+            for slot in slots:
+                counts[slot] += count
+            records[key] = self._pack_counts(counts)
+        self._check(self.set_bulk(records, False))
+
+    def add_counts(self, feature_counts, category_counts,
+                   chunk_size=FLUSH_CHUNK_SIZE):
+        """
+        Add counts accumulated outside the database. `feature_counts` maps
+        each feature to a dictionary of category -> count, and
+        `category_counts` maps each category to its number of documents.
+        Features are read and written back `chunk_size` records at a time
+        using bulk gets and sets.
+        """
+        for category in category_counts:
+            self._category_slot(category)
+
+        items = list(feature_counts.items())
+        for start in range(0, len(items), chunk_size):
+            chunk = items[start:start + chunk_size]
+            keys = [self._feature_key(feature) for feature, _ in chunk]
+            values = self._check(self.get_bulk(keys, False))
+
+            records = {}
+            for key, (_, counts_by_category) in zip(keys, chunk):
+                counts = self._unpack_counts(values.get(key))
+                for category, count in counts_by_category.items():
+                    counts[self._category_slot(category)] += count
+                records[key] = self._pack_counts(counts)
+            self._check(self.set_bulk(records, False))
+
+        self._check(self.increment(
+            self._total_count,
+            sum(category_counts.values())))
+        for category, count in category_counts.items():
+            self._check(self.increment(self._category_key(category), count))
 
     def incr_category(self, category):
         """
         Increment the count for the given category, increasing the total
         count as well.
         """
-        self.increment(self._total_count, 1)
-        return self.increment(self._category_tmpl % category, 1)
+        self._category_slot(category)
+        self._check(self.increment(self._total_count, 1))
+        return self._check(self.increment(self._category_key(category), 1))
 
     def category_count(self, category):
         """Return the number of documents in the given category."""
-        return self.get_int(self._category_tmpl % category)
+        return self.get_int(self._category_key(category))
 
     def total_count(self):
         """Return the total number of documents overall."""
@@ -47,42 +282,110 @@ class ClassifierDB(kc.DB):
 
     def get_feature_category_count(self, feature, category):
         """Get the count of the feature in the given category."""
-        return self.get_int(
-            self._feature_to_category_tmpl % (feature, category))
+        if category not in self._category_index:
+            return 0
+        counts = self._unpack_counts(self.get(self._feature_key(feature)))
+        return counts[self._category_index[category]]
 
-    def get_feature_counts(self, feature):
+    def feature_total(self, feature):
         """Get the total count for the feature across all categories."""
-        prefix = self._feature_to_category_tmpl % (feature, '')
-        total = 0
-        for key in self.match_prefix(prefix):
-            total += self.get_int(key)
-        return total
+        return sum(self._unpack_counts(self.get(self._feature_key(feature))))
+
+    def get_counts(self, features, categories):
+        """
+        Fetch every count needed to score the features against the
+        categories with a single bulk read. Returns a 4-tuple of the total
+        document count, a dictionary mapping category to document count,
+        a dictionary mapping feature to its per-category counts and a
+        dictionary mapping feature to its total across all categories.
+        """
+        keys = [self._total_count]
+        keys.extend(self._category_key(category) for category in categories)
+        keys.extend(self._feature_key(feature) for feature in features)
+        values = self.get_bulk(keys, False)
+
+        def get_int(key):
+            value = values.get(key)
+            if value:
+                return _unpack_int(value)[0]
+            return 0
+
+        total = get_int(self._total_count)
+        category_counts = dict(
+            (category, get_int(self._category_key(category)))
+            for category in categories)
+        slots = [
+            (category, self._category_index.get(category))
+            for category in categories]
+        feature_counts = {}
+        feature_totals = {}
+        for feature in features:
+            counts = self._unpack_counts(
+                values.get(self._feature_key(feature)))
+            feature_counts[feature] = dict(
+                (category, counts[slot] if slot is not None else 0)
+                for category, slot in slots)
+            feature_totals[feature] = sum(counts)
+        return total, category_counts, feature_counts, feature_totals
 
     def iter_categories(self):
         """
         Return an iterable that successively yields all the categories
         that have been observed.
         """
-        category_prefix = self._category_tmpl % ''
-        prefix_len = len(category_prefix)
-        for category_key in self.match_prefix(category_prefix):
-            yield category_key[prefix_len:]
+        return iter(self._categories)
 
 
 class NBC(object):
     """
     Simple naive bayes classifier.
     """
-    def __init__(self, filename, read_only=False):
+    __slots__ = ('filename', 'tuning', 'bulk_train_mode', 'db',
+                 '_classify_cache', '_pending_features', '_pending_categories')
+
+    def __init__(self, filename, read_only=False, bnum=20000,
+                 msiz=512 * 1024 * 1024, opts='l', apow=None,
+                 bulk_train_mode=False):
         """
         Initialize the classifier by pointing it at a database file. If you
         intend to only use the classifier for classifying documents, specify
         `read_only=True`.
+
+        When `bulk_train_mode=True`, `train()` only accumulates counts in
+        memory, and they are written to the database in bulk by `flush()`
+        (which is called for you before counts are read and on `close()`).
+
+        The remaining parameters are Kyoto Cabinet tuning parameters which
+        are appended to the filename when the database is opened (pass
+        `None` to use Kyoto's default). A `.kct` file is a tree database,
+        whose buckets index B+ tree pages rather than individual records;
+        Kyoto suggests about 10% of the expected record count, so the
+        default `bnum` suits around 2 * 10^5 features. The defaults also
+        map 512MB of the file into memory and use linear collision
+        chaining. Note that `bnum`, `opts` and `apow` only take effect when
+        the database file is created.
         """
         self.filename = filename
         if not self.filename.endswith('.kct'):
             raise RuntimeError('Database filename must have "kct" extension.')
 
+        self.tuning = dict(
+            (key, value) for key, value in (
+                ('bnum', bnum),
+                ('msiz', msiz),
+                ('opts', opts),
+                ('apow', apow))
+            if value is not None)
+
+        self.bulk_train_mode = bulk_train_mode
+        self._pending_features = defaultdict(Counter)
+        self._pending_categories = Counter()
+
+        # Scores of recently classified feature sets, least recently used
+        # first. Emails often share their boilerplate, so identical sets of
+        # features come up again and again.
+        self._classify_cache = OrderedDict()
+
         self.db = ClassifierDB()
         self.connect(read_only=read_only)
 
@@ -99,79 +402,222 @@ class NBC(object):
             flags = kc.DB.OREADER
         else:
             flags = kc.DB.OWRITER
-        self.db.open(self.filename, flags | kc.DB.OCREATE)
+        path = self.filename + ''.join(
+            '#%s=%s' % item for item in sorted(self.tuning.items()))
+        self.db.open(path, flags | kc.DB.OCREATE)
 
     def close(self):
-        """Close the database."""
+        """Close the database, writing out any pending training counts."""
+        self.flush()
         self.db.close()
 
+    def flush(self):
+        """
+        Write the counts accumulated by `train()` in bulk training mode to
+        the database. The counts are applied in a single transaction and
+        every write is checked, so a failed flush raises, leaves the database
+        untouched and keeps the pending counts to be retried.
+        """
+        if not self._pending_categories:
+            return
+        with self.db.transaction():
+            self.db.add_counts(
+                self._pending_features,
+                self._pending_categories)
+        self._pending_features.clear()
+        self._pending_categories.clear()
+
     def train(self, features, *categories):
         """
         Increment the counts for the features in the given categories.
         """
-        for category in categories:
-            for feature in features:
-                self.db.incr_feature_category(feature, category)
-            self.db.incr_category(category)
+        # Documents repeat words a lot, so collapse the features into counts
+        # and apply them in a single transaction, reading and writing each
+        # unique feature once rather than once per occurrence.
+        feature_counts = Counter(features)
+        self._classify_cache.clear()
+        if self.bulk_train_mode:
+            for category in categories:
+                for feature, count in feature_counts.items():
+                    self._pending_features[feature][category] += count
+                self._pending_categories[category] += 1
+            return
+
+        with self.db.transaction():
+            self.db.incr_feature_categories(feature_counts, categories)
+            for category in categories:
+                self.db.incr_category(category)
+
+    def get_counts(self, features):
+        """
+        Fetch the counts needed to score the features against every known
+        category. The result can be passed to the probability methods to
+        avoid reading the same values from the database repeatedly. Any
+        counts pending in bulk training mode are flushed first.
+        """
+        self.flush()
+        return self.db.get_counts(features, list(self.db.iter_categories()))
 
-    def feature_probability(self, feature, category):
+    def feature_probability(self, feature, category, counts=None):
         """
         Calculate the probability that a particular feature is associated
         with the given category.
         """
-        fcc = self.db.get_feature_category_count(feature, category)
-        if fcc:
-            category_count = self.db.category_count(category)
+        if counts is None:
+            counts = self.get_counts([feature])
+        _, category_counts, feature_counts, _ = counts
+        fcc = feature_counts[feature].get(category, 0)
+        category_count = category_counts.get(category, 0)
+        if fcc and category_count:
             return float(fcc) / category_count
         return 0
 
-    def weighted_probability(self, feature, category, weight=1.0):
+    def weighted_probability(self, feature, category, weight=1.0,
+                             counts=None):
         """
         Determine the probability a feature corresponds to the given category.
         The probability is weighted by the importance of the feature, which
         is determined by looking at the feature across all categories in
         which it appears.
         """
-        initial_prob = self.feature_probability(feature, category)
-        totals = self.db.get_feature_counts(feature)
+        if counts is None:
+            counts = self.get_counts([feature])
+        initial_prob = self.feature_probability(feature, category, counts)
+        totals = counts[3][feature]
         return ((weight * 0.5) + (totals * initial_prob)) / (weight + totals)
 
-    def document_probability(self, features, category):
+    def document_probability(self, features, category, counts=None):
         """
-        Calculate the probability that a set of features match the given
-        category.
+        Calculate the log-probability that a set of features match the given
+        category. Summing logs rather than multiplying the probabilities
+        keeps long documents from underflowing to zero.
         """
-        feature_probabilities = [
-            self.weighted_probability(feature, category)
-            for feature in features]
-        return reduce(operator.mul, feature_probabilities, 1)
+        occurrences = Counter(features)
+        if counts is None:
+            counts = self.get_counts(list(occurrences))
+        return self._document_probability(occurrences, category, counts)
+
+    def _document_probability(self, occurrences, category, counts):
+        # Does the work of `document_probability()` given a `Counter` of the
+        # features. Each distinct feature is scored once and its
+        # log-probability weighted by the number of times it occurs.
+        _, category_counts, feature_counts, feature_totals = counts
+        cat_count = category_counts.get(category, 0)
+        if _score is not None and cat_count:
+            # Hand the arithmetic to the compiled scorer when numba is
+            # available.
+            features = list(occurrences)
+            n = len(features)
+            fcc_arr = np.fromiter(
+                (feature_counts[feature].get(category, 0)
+                 for feature in features),
+                np.float64,
+                n)
+            totals_arr = np.fromiter(
+                (feature_totals[feature] for feature in features),
+                np.float64,
+                n)
+            occurrences_arr = np.fromiter(
+                (occurrences[feature] for feature in features),
+                np.float64,
+                n)
+            return float(_score(
+                fcc_arr,
+                float(cat_count),
+                totals_arr,
+                occurrences_arr))
+
+        return sum(
+            occurrence * math.log(max(
+                self.weighted_probability(feature, category, counts=counts),
+                MIN_PROBABILITY))
+            for feature, occurrence in occurrences.items())
 
-    def weighted_document_probability(self, features, category):
+    def weighted_document_probability(self, features, category, counts=None):
         """
-        Calculate the probability that a set of features match the given
+        Calculate the log-probability that a set of features match the given
         category, and weight that score by the importance of the category.
         """
-        if self.db.total_count() == 0:
-            # Avoid divison by zero.
-            return 0
+        occurrences = Counter(features)
+        if counts is None:
+            counts = self.get_counts(list(occurrences))
+        total, category_counts, _, _ = counts
+        if total == 0:
+            # Avoid divison by zero; log(0) is negative infinity.
+            return float('-inf')
+
+        return self._weighted_document_probability(
+            occurrences,
+            category,
+            total,
+            category_counts.get(category, 0),
+            counts)
 
-        cat_prob = (float(self.db.category_count(category)) /
-                    self.db.total_count())
-        doc_prob = self.document_probability(features, category)
-        return doc_prob * cat_prob
+    def _cache_key(self, occurrences):
+        # Identify a bag of features by a digest over its sorted
+        # (feature, count) pairs, together with the number of distinct
+        # features and occurrences, which guard against digest collisions.
+        digest = hashlib.blake2b(digest_size=16)
+        for feature, count in sorted(
+                (_to_bytes(feature), count)
+                for feature, count in occurrences.items()):
+            digest.update(_pack_feature_count(len(feature), count))
+            digest.update(feature)
+        return (
+            digest.digest(),
+            len(occurrences),
+            sum(occurrences.values()))
+
+    def _weighted_document_probability(self, occurrences, category, total,
+                                       cat_count, counts):
+        # Does the work of `weighted_document_probability()` using the
+        # already-fetched document counts.
+        cat_prob = max(float(cat_count) / total, MIN_PROBABILITY)
+        doc_prob = self._document_probability(occurrences, category, counts)
+        return math.log(cat_prob) + doc_prob
 
     def classify(self, features, limit=5):
         """
         Classify the features by finding the categories that match the
-        features with the highest probability.
+        features with the highest probability. Returns a list of
+        `(category, log-probability)` pairs, most probable first.
         """
-        probabilities = {}
-        for category in self.db.iter_categories():
-            probabilities[category] = self.weighted_document_probability(
-                features,
-                category)
+        # Repeated features only need to be read and scored once, and a bag
+        # of features we have already scored can reuse the earlier result.
+        occurrences = Counter(features)
+        cache_key = self._cache_key(occurrences)
+        probabilities = self._classify_cache.get(cache_key)
+        if probabilities is not None:
+            self._classify_cache.move_to_end(cache_key)
+        else:
+            # Read all the counts we need up-front in a single bulk call
+            # rather than issuing several gets per feature and category. The
+            # total and per-category document counts stay fixed while we
+            # score.
+            counts = self.get_counts(list(occurrences))
+            total, category_counts, _, _ = counts
+            if total == 0:
+                return []
+
+            # A category can have a slot without any documents, when its
+            # features were counted directly, so only score the categories
+            # that have been trained.
+            probabilities = {}
+            for category, cat_count in category_counts.items():
+                if not cat_count:
+                    continue
+                probabilities[category] = self._weighted_document_probability(
+                    occurrences,
+                    category,
+                    total,
+                    cat_count,
+                    counts)
+
+            self._classify_cache[cache_key] = probabilities
+            if len(self._classify_cache) > CLASSIFY_CACHE_SIZE:
+                self._classify_cache.popitem(last=False)
 
-        return sorted(
+        return heapq.nlargest(
+            limit,
             probabilities.items(),
-            key=operator.itemgetter(1),
-            reverse=True)[:limit]
+            key=operator.itemgetter(1))